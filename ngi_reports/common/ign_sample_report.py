@@ -4,14 +4,237 @@
 """
 
 import jinja2
+import multiprocessing
+import numpy as np
 import os
 import re
+import threading
+from collections import namedtuple
 from datetime import datetime
 
 import ngi_reports.common
 from ngi_visualizations.qualimap import coverage_histogram, genome_fraction_coverage, insert_size, gc_distribution
 from ngi_visualizations.snpEff import snpEff_plots
 
+# Seconds to wait for a sample's plots. On Python 2, AsyncResult.get() with
+# no timeout can't be interrupted, so Ctrl-C would hang the run
+_PLOT_TIMEOUT = 24 * 60 * 60
+
+# Summary fields in the Qualimap genome_results.txt file, eg.
+#   number of reads = 908,585,160
+#   number of mapped reads = 903,806,933 (99.47%)
+#   GC percentage = 39.87%
+#   mean coverageData = 29.04X
+#   There is a 51.72% of reference with a coverageData >= 30X
+# Group names are the sample fields that they are saved to
+_QUALIMAP_FIELDS_RE = re.compile(br'^[ \t]*(?:'
+    br'number of reads *= *(?P<total_reads>[\d,]+)'
+    br'|number of mapped reads *= *(?P<aligned_reads>[\d,]+) *\((?P<percent_aligned>[\d.]+%)\)'
+    br'|GC percentage *= *(?P<percent_gc>[\d.]+%)'
+    br'|mean coverageData *= *(?P<mean_coverage>[\d.,]+)X'
+    br'|There is a (?P<ref_above_30X>[\d.]+%) of reference with a coverageData >= 30X'
+    br')[ \t\r]*$', re.M)
+
+# Rows of the Qualimap coverage per contig block with a numeric contig name:
+#   <contig> <length> <mapped bases> <mean coverage> <standard deviation>
+_QUALIMAP_CONTIG_RE = re.compile(br'^[ \t]*(\d+)[ \t]+(\S+)[ \t]+(\S+)', re.M)
+
+# Insert size quartiles in the Qualimap HTML report:
+#   <td class=column1>P25/Median/P75</td>
+#   <td class=column2>318 / 369 / 422</td>
+_QUALIMAP_INSERT_SIZE_RE = re.compile(br'<td class=column1>P25/Median/P75</td>\s*'
+    br'<td class=column2>\s*\d+\s*/\s*(\d+)\s*/')
+
+# Lines of interest in the snpEff summary CSV, matched in a single scan, eg.
+#   Number_of_variants_before_filter, 4004647
+#   MISSENSE , 10581 , 47.8%
+# Captures the row name and everything after the first comma. Newer versions
+# of snpEff use Sequence Ontology effect names, older ones use their own, so
+# there is one pattern for each with only the rows that version writes.
+_SNPEFF_NEW_RE = re.compile(br'^[ \t]*(Number_of_variants_before_filter|Change_rate|Het|Hom'
+    br'|MISSENSE|NONSENSE|SILENT|synonymous_variant|stop_gained|stop_lost|Ts_Tv_ratio) *,(.*)$', re.M)
+_SNPEFF_OLD_RE = re.compile(br'^[ \t]*(Number_of_variants_before_filter|Change_rate|MISSENSE|NONSENSE|SILENT|Ts_Tv_ratio'
+    br'|SNP|NON_SYNONYMOUS[^,\n]*|SYNONYMOUS[^,\n]*|STOP_GAINED|STOP_LOST) *,(.*)$', re.M)
+
+# Rows only written by older snpEff versions: their own effect names, or the
+# Type, Total, Homo, Hetero table, eg.
+#   SYNONYMOUS_CODING , 10764 , 0.2118%
+#   SNP , 4004647 , 1491592 , 2513055
+_SNPEFF_OLD_SCHEMA_RE = re.compile(br'^[ \t]*(?:SYNONYMOUS_CODING|NON_SYNONYMOUS_'
+    br'|SNP *,[^,\n]*,[^,\n]*,)', re.M)
+
+# Fields that must be set before a report can be made
+_REQUIRED_REPORT_FIELDS = frozenset([])
+_REQUIRED_PROJECT_FIELDS = frozenset(['id', 'sequencing_centre', 'sequencing_platform', 'ref_genome'])
+_REQUIRED_SAMPLE_FIELDS = frozenset(['total_reads', 'percent_aligned', 'aligned_reads', 'median_insert_size',
+    'automsomal_coverage', 'ref_above_30X', 'percent_gc'])
+_REQUIRED_PLOT_FIELDS = frozenset(['coverage_plot', 'cov_frac_plot', 'insert_size_plot', 'gc_dist_plot', 'snpEFf_plot'])
+
+# Locations of the per-sample Piper output files used for the report
+SamplePaths = namedtuple('SamplePaths', ['qc_dir', 'genome_results', 'qualimap_report',
+    'snpeff_csv', 'picard_metrics', 'qualimap_raw_dir'])
+
+def _qualimap_section(buf, title):
+    """ Returns the body of the '>>>>>>> title' section of a Qualimap
+    genome_results.txt file, up to the next section header. Returns an
+    empty bytes string if the section isn't there.
+    """
+    header = b'>>>>>>> ' + title
+    if buf.startswith(header):
+        start = 0
+    else:
+        start = buf.find(b'\n' + header)
+        if start == -1:
+            return b''
+    start = buf.find(b'\n', start + 1)
+    if start == -1:
+        return b''
+    end = buf.find(b'\n>>>>>>>', start)
+    if end == -1:
+        end = len(buf)
+    return buf[start + 1:end]
+
+def _parse_snpeff_common(key, sections, snpEff, counts):
+    """ Handles the snpEff summary rows written by all versions of snpEff
+    """
+    if key == b'Number_of_variants_before_filter':
+        counts['total_snps'] = int(sections[0])
+
+    elif key == b'Change_rate':
+        snpEff['change_rate'] = '1 change per {:,} bp'.format(int(sections[0]))
+
+    elif key == b'Ts_Tv_ratio':
+        snpEff['TsTv_ratio'] = '{:.3f}'.format(float(sections[0]))
+
+    # MISSENSE , 10581 , 47.8%
+    elif key in (b'MISSENSE', b'NONSENSE', b'SILENT'):
+        effect = key.lower().decode('ascii')
+        snpEff['percent_{}_SNPs'.format(effect)] = '{:.1f}%'.format(float(sections[1].strip(b' \t\r%')))
+        counts['{}_SNPs'.format(effect)] = int(sections[0])
+
+def _parse_snpeff_new(buf, snpEff, counts):
+    """ Parses a snpEff summary CSV written by newer versions of snpEff,
+    which use Sequence Ontology effect names
+    """
+    for key, values in _SNPEFF_NEW_RE.findall(buf):
+        sections = values.split(b',')
+
+        if key == b'Het':
+            counts['heterotypic_snps'] = int(sections[0])
+
+        elif key == b'Hom':
+            counts['homotypic_snps'] = int(sections[0])
+
+        elif key == b'synonymous_variant':
+            counts['synonymous_SNPs'] += int(sections[0])
+
+        elif key == b'stop_gained':
+            counts['stops_gained'] = int(sections[0])
+
+        elif key == b'stop_lost':
+            counts['stops_lost'] = int(sections[0])
+
+        else:
+            _parse_snpeff_common(key, sections, snpEff, counts)
+
+def _parse_snpeff_old(buf, snpEff, counts):
+    """ Parses a snpEff summary CSV written by older versions of snpEff
+    """
+    for key, values in _SNPEFF_OLD_RE.findall(buf):
+        sections = values.split(b',')
+
+        # Type, Total, Homo, Hetero
+        # SNP , 4004647 , 1491592 , 2513055
+        if key == b'SNP':
+            counts['homotypic_snps'] = int(sections[1])
+            counts['heterotypic_snps'] = int(sections[2])
+
+        elif key.startswith(b'NON_SYNONYMOUS'):
+            counts['nonsynonymous_SNPs'] += int(sections[0])
+
+        elif key.startswith(b'SYNONYMOUS'):
+            counts['synonymous_SNPs'] += int(sections[0])
+
+        elif key == b'STOP_GAINED':
+            counts['stops_gained'] = int(sections[0])
+
+        elif key == b'STOP_LOST':
+            counts['stops_lost'] = int(sections[0])
+
+        else:
+            _parse_snpeff_common(key, sections, snpEff, counts)
+
+def _prefetch_files(paths):
+    """ Ask the kernel to start reading the given files into the page cache,
+    so that they're ready by the time that they are parsed. This is only a
+    hint, so missing files and platforms without posix_fadvise are ignored.
+    """
+    fadvise = getattr(os, 'posix_fadvise', None)
+    if fadvise is None:
+        return
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+def _render_sample_plots(sample_id, paths, report_dir):
+    """ Plot the visualizations for one sample of the IGN sample report and
+    return the dict of plot paths, relative to report_dir. Kept at module
+    level so that it can be run in a multiprocessing worker.
+    """
+    plots = {}
+
+    # Create the plots subdirectory
+    plots_dir_rel = os.path.join('plots', sample_id)
+    plots_dir = os.path.realpath(os.path.join(report_dir, plots_dir_rel))
+    if not os.path.exists(plots_dir):
+        os.makedirs(plots_dir)
+
+    # Qualimap coverage plot
+    cov_fn = os.path.join(paths.qualimap_raw_dir, 'coverage_histogram.txt')
+    cov_output_rel = os.path.join(plots_dir_rel, '{}_coverage'.format(sample_id))
+    cov_output = os.path.join(plots_dir, '{}_coverage'.format(sample_id))
+    coverage_histogram.plot_coverage_histogram(cov_fn, cov_output)
+    plots['coverage_plot'] = cov_output_rel
+
+    # Qualimap genome fraction coverage plot
+    cov_frac_fn = os.path.join(paths.qualimap_raw_dir, 'genome_fraction_coverage.txt')
+    cov_frac_output_rel = os.path.join(plots_dir_rel, '{}_genome_fraction'.format(sample_id))
+    cov_frac_output = os.path.join(plots_dir, '{}_genome_fraction'.format(sample_id))
+    genome_fraction_coverage.plot_genome_fraction_coverage(cov_frac_fn, cov_frac_output)
+    plots['cov_frac_plot'] = cov_frac_output_rel
+
+    # Qualimap insert size plot
+    insert_size_fn = os.path.join(paths.qualimap_raw_dir, 'insert_size_histogram.txt')
+    insert_size_output_rel = os.path.join(plots_dir_rel, '{}_insert_size'.format(sample_id))
+    insert_size_output = os.path.join(plots_dir, '{}_insert_size'.format(sample_id))
+    insert_size.plot_insert_size_histogram(insert_size_fn, insert_size_output)
+    plots['insert_size_plot'] = insert_size_output_rel
+
+    # Qualimap GC distribution plot
+    gc_fn = os.path.join(paths.qualimap_raw_dir, 'mapped_reads_gc-content_distribution.txt')
+    gc_output_rel = os.path.join(plots_dir_rel, '{}_gc_distribution'.format(sample_id))
+    gc_output = os.path.join(plots_dir, '{}_gc_distribution'.format(sample_id))
+    gc_distribution.plot_genome_fraction_coverage(gc_fn, gc_output)
+    plots['gc_dist_plot'] = gc_output_rel
+
+    # snpEff plot
+    snpEFf_fn = paths.snpeff_csv
+    snpEFf_output_rel = os.path.join(plots_dir_rel, '{}_snpEff_effect'.format(sample_id))
+    snpEFf_output = os.path.join(plots_dir, '{}_snpEff_effect'.format(sample_id))
+    snpEff_plots.plot_snpEff(snpEFf_fn, snpEFf_output)
+    plots['snpEFf_plot'] = '{}_regions'.format(snpEFf_output_rel)
+
+    return plots
+
+
 class CommonReport(ngi_reports.common.BaseReport):
 
     def __init__(self, config, LOG, working_dir, **kwargs):
@@ -24,6 +247,11 @@ class CommonReport(ngi_reports.common.BaseReport):
         self.project = {}
         self.samples = {}
         self.plots = {}
+        self.sample_paths = {}
+
+        # Piper output directories shared by all samples, only resolved once
+        self.variant_calls_dir = os.path.realpath(os.path.join(self.working_dir, '07_variant_calls'))
+        self.processed_alignments_dir = os.path.realpath(os.path.join(self.working_dir, '05_processed_alignments'))
 
         # Scrape information from the filesystem
         # This function is in the common BaseReport class in __init__.py
@@ -41,87 +269,113 @@ class CommonReport(ngi_reports.common.BaseReport):
         if len(self.samples) == 0:
             raise IOError ('No samples found!')
 
-        # Get more info from the filesystem
-        self.LOG.info('Parsing QC files')
-        self.parse_qualimap()
-        self.parse_snpeff()
-        self.parse_picard_metrics()
-
         # Plot graphs
+        # The plots are made straight from the QC files, so they are
+        # rendered in the background while the parsing below runs
         self.LOG.info('Plotting graphs')
-        self.make_plots()
+        pool, plot_jobs = self._start_plots()
+
+        try:
+            # Start reading the QC files from disk in the background. This
+            # waits until the plotting pool has forked, as forking while
+            # another thread is running is unsafe
+            prefetch_paths = []
+            for sample_id in self.samples:
+                paths = self._sample_paths(sample_id)
+                prefetch_paths.extend([paths.genome_results, paths.qualimap_report,
+                    paths.snpeff_csv, paths.picard_metrics])
+            prefetch = threading.Thread(target=_prefetch_files, args=(prefetch_paths,))
+            prefetch.daemon = True
+            prefetch.start()
+
+            # Get more info from the filesystem
+            self.LOG.info('Parsing QC files')
+            self.parse_qualimap()
+            self.parse_snpeff()
+            self.parse_picard_metrics()
+
+            self._collect_plots(plot_jobs)
+        except BaseException:
+            # Don't leave the workers plotting for a report that has failed
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+
+
+    def _batch_read_files(self, paths):
+        """ Reads each of the given files in full with a single read() call
+        and returns their raw bytes in the same order, ready to be parsed
+        in memory. Only the fields that we keep are decoded afterwards.
+        Raises IOError if any of the files can't be read.
+        """
+        contents = []
+        for path in paths:
+            with open(path, 'rb') as fh:
+                contents.append(fh.read())
+        return contents
+
+
 
+    def _sample_paths(self, sample_id):
+        """ Returns the SamplePaths for a sample. The sample's QC directory is
+        only resolved with realpath once and the result is cached for the
+        parse and plot passes.
+        """
+        if sample_id not in self.sample_paths:
+            qc_dir = os.path.realpath(os.path.join(self.working_dir, '06_final_alignment_qc',
+                '{}.clean.dedup.recal.qc'.format(sample_id)))
+            self.sample_paths[sample_id] = SamplePaths(
+                qc_dir=qc_dir,
+                genome_results=os.path.join(qc_dir, 'genome_results.txt'),
+                qualimap_report=os.path.join(qc_dir, 'qualimapReport.html'),
+                snpeff_csv=os.path.join(self.variant_calls_dir,
+                    '{}.clean.dedup.recal.bam.raw.annotated.vcf.snpEff.summary.csv'.format(sample_id)),
+                picard_metrics=os.path.join(self.processed_alignments_dir, '{}.metrics'.format(sample_id)),
+                qualimap_raw_dir=os.path.join(qc_dir, 'raw_data_qualimapReport'))
+        return self.sample_paths[sample_id]
 
 
 
     def parse_qualimap(self):
         """ Looks for qualimap results files and adds to class
         """
-        for sample_id in self.samples.iterkeys():
+        for sample_id, sample in self.samples.items():
             # Build the expected filenames
-            qualimap_data_dir = os.path.join(self.working_dir, '06_final_alignment_qc',
-                '{}.clean.dedup.recal.qc'.format(sample_id))
-            genome_results = os.path.join(qualimap_data_dir, 'genome_results.txt')
-            qualimap_report = os.path.join(qualimap_data_dir, 'qualimapReport.html')
+            paths = self._sample_paths(sample_id)
             try:
-                cov_per_contig = False
-                autosomal_cov_length = 0
-                autosomal_cov_bases = 0
-                with open(os.path.realpath(genome_results), 'r') as fh:
-                    for line in fh:
-                        line = line.strip()
-
-                        # number of reads = 908,585,160
-                        if line[:17] == 'number of reads =':
-                            self.samples[sample_id]['total_reads'] = line[18:]
-
-                        # number of mapped reads = 903,806,933 (99.47%)
-                        if line[:24] == 'number of mapped reads =':
-                            self.samples[sample_id]['percent_aligned'] = line[-7:-1]
-                            self.samples[sample_id]['aligned_reads'] = line[25:-9]
-
-                        # GC percentage = 39.87%
-                        if line[:15] == 'GC percentage =':
-                            self.samples[sample_id]['percent_gc'] = line[-6:]
-
-                        # mean coverageData = 29.04X
-                        if line[:19] == 'mean coverageData =':
-                            self.samples[sample_id]['mean_coverage'] = line[20:-1]
-
-                        # There is a 51.72% of reference with a coverageData >= 30X
-                        if line[-39:] == 'of reference with a coverageData >= 30X':
-                            self.samples[sample_id]['ref_above_30X'] = line[11:17]
-
-                        # >>>>>>> Coverage per contig
-                        if line == '>>>>>>> Coverage per contig':
-                            cov_per_contig = True
-                        elif line[:7] == '>>>>>>>':
-                            cov_per_contig = False
-                        if cov_per_contig and line:
-                            sections = line.split()
-                            if sections[0].isdigit() and int(sections[0]) <= 22:
-                                autosomal_cov_length += float(sections[1])
-                                autosomal_cov_bases += float(sections[2])
+                genome_results_buf, = self._batch_read_files([paths.genome_results])
+
+                # Pull all of the summary fields out in a single scan
+                for match in _QUALIMAP_FIELDS_RE.finditer(genome_results_buf):
+                    for field, value in match.groupdict().items():
+                        if value is not None:
+                            sample[field] = value.decode('ascii')
+
+                # >>>>>>> Coverage per contig
+                # Columns: contig, length, mapped bases
+                cov_per_contig = _qualimap_section(genome_results_buf, b'Coverage per contig')
+                contigs = np.array(_QUALIMAP_CONTIG_RE.findall(cov_per_contig), dtype=float).reshape(-1, 3)
+                autosomal = contigs[contigs[:, 0] <= 22]
+                autosomal_cov_length = autosomal[:, 1].sum()
+                autosomal_cov_bases = autosomal[:, 2].sum()
 
                 if autosomal_cov_length > 0 and autosomal_cov_bases > 0:
                     autosomal_cov = autosomal_cov_bases / autosomal_cov_length
-                    self.samples[sample_id]['automsomal_coverage'] = '{:.2f}'.format(autosomal_cov)
+                    sample['automsomal_coverage'] = '{:.2f}'.format(autosomal_cov)
 
 
                 # Why is this not in the text file? This makes me a sad panda.
-                with open(os.path.realpath(qualimap_report), 'r') as fh:
-                    for line in fh:
-                        line = line.strip()
-
-                        # <td class=column1>P25/Median/P75</td>
-                        # <td class=column2>318 / 369 / 422</td>
-                        if line == '<td class=column1>P25/Median/P75</td>':
-                            line = next(fh)
-                            quartiles = line[18:-5].split('/',3)
-                            self.samples[sample_id]['median_insert_size'] = quartiles[1].strip()
+                # Read separately so that a missing HTML report doesn't lose
+                # the fields above
+                qualimap_report_buf, = self._batch_read_files([paths.qualimap_report])
+                quartiles = _QUALIMAP_INSERT_SIZE_RE.search(qualimap_report_buf)
+                if quartiles:
+                    sample['median_insert_size'] = quartiles.group(1).decode('ascii')
 
-            except:
-                self.LOG.error("Something went wrong with parsing the Qualimap results for sample {}".format(sample_id))
+            except (IOError, OSError, ValueError, IndexError, KeyError):
+                self.LOG.error("Something went wrong with parsing the Qualimap results for sample {}".format(sample_id), exc_info=True)
 
 
 
@@ -131,246 +385,185 @@ class CommonReport(ngi_reports.common.BaseReport):
         """ Parse the snpEff output to get information about SNPs
         """
 
-        for sample_id in self.samples.iterkeys():
+        for sample_id, sample in self.samples.items():
 
             snpEff = {}
+            # Integer fields, formatted with thousands separators in one go at the end
+            counts = {}
             # Build the expected filenames
-            snpEff_csv = os.path.realpath(os.path.join(self.working_dir, '07_variant_calls',
-                '{}.clean.dedup.recal.bam.raw.annotated.vcf.snpEff.summary.csv'.format(sample_id)))
+            paths = self._sample_paths(sample_id)
             try:
-                synonymous_SNPs = 0
-                nonsynonymous_SNPs = 0
-
-                with open(os.path.realpath(snpEff_csv), 'r') as fh:
-                    for line in fh:
-                        line = line.strip()
-
-                        if line[:33] == 'Number_of_variants_before_filter,':
-                            snpEff['total_snps'] = '{:,}'.format(int(line[34:]))
-
-                        if line[:13] == 'Change_rate ,':
-                            snpEff['change_rate'] = '1 change per {:,} bp'.format(int(line[14:]))
-
-                        if line[:5] == 'Het ,':
-                            snpEff['heterotypic_snps'] = '{:,}'.format(int(line[6:]))
+                counts['synonymous_SNPs'] = 0
+                counts['nonsynonymous_SNPs'] = 0
 
-                        if line[:5] == 'Hom ,':
-                            snpEff['homotypic_snps'] = '{:,}'.format(int(line[6:]))
+                snpEff_buf, = self._batch_read_files([paths.snpeff_csv])
+                # Files only use one set of row names, so work out which once
+                if _SNPEFF_OLD_SCHEMA_RE.search(snpEff_buf):
+                    _parse_snpeff_old(snpEff_buf, snpEff, counts)
+                else:
+                    _parse_snpeff_new(snpEff_buf, snpEff, counts)
 
-                        if line[:10] == 'MISSENSE ,':
-                            sections = line.split(',')
-                            pc = sections[2].strip()
-                            pc = float(pc[:-1])
-                            snpEff['percent_missense_SNPs'] = '{:.1f}%'.format(pc)
-                            snpEff['missense_SNPs'] = '{:,}'.format(int(sections[1].strip()))
+            except (IOError, OSError, ValueError, IndexError, KeyError):
+                self.LOG.error("Something went wrong with parsing the snpEff results for sample {}".format(sample_id), exc_info=True)
 
-                        if line[:10] == 'NONSENSE ,':
-                            sections = line.split(',')
-                            pc = sections[2].strip()
-                            pc = float(pc[:-1])
-                            snpEff['percent_nonsense_SNPs'] = '{:.1f}%'.format(pc)
-                            snpEff['nonsense_SNPs'] = '{:,}'.format(int(sections[1].strip()))
+            # Synonymous counts are totals over several rows, only report them if we found some
+            if not counts.get('synonymous_SNPs'):
+                counts.pop('synonymous_SNPs', None)
+            if not counts.get('nonsynonymous_SNPs'):
+                counts.pop('nonsynonymous_SNPs', None)
+            snpEff.update((field, '{:,}'.format(count)) for field, count in counts.items())
 
-                        if line[:8] == 'SILENT ,':
-                            sections = line.split(',')
-                            pc = sections[2].strip()
-                            pc = float(pc[:-1])
-                            snpEff['percent_silent_SNPs'] = '{:.1f}%'.format(pc)
-                            snpEff['silent_SNPs'] = '{:,}'.format(int(sections[1].strip()))
-
-                        if line[:20] == 'synonymous_variant ,':
-                            sections = line.split(',')
-                            synonymous_SNPs += int(sections[1].strip())
-
-                        if line[:13] == 'stop_gained ,':
-                            sections = line.split(',')
-                            snpEff['stops_gained'] = '{:,}'.format(int(sections[1].strip()))
-
-                        if line[:11] == 'stop_lost ,':
-                            sections = line.split(',')
-                            snpEff['stops_lost'] = '{:,}'.format(int(sections[1].strip()))
-
-                        if line[:13] == 'Ts_Tv_ratio ,':
-                            snpEff['TsTv_ratio'] = '{:.3f}'.format(float(line[14:]))
-
-
-                        # ALTERNATIVE BLOCKS FOR OLDER VERSION OF SNPEFF
-                        # Type, Total, Homo, Hetero
-                        # SNP , 4004647 , 1491592 , 2513055
-                        if line[:5] == 'SNP ,':
-                            sections = line.split(',')
-                            snpEff['homotypic_snps'] = '{:,}'.format(int(sections[2].strip()))
-                            snpEff['heterotypic_snps'] = '{:,}'.format(int(sections[3].strip()))
-
-                        if line[:10] == 'SYNONYMOUS':
-                            sections = line.split(',')
-                            synonymous_SNPs += int(sections[1].strip())
-
-                        if line[:14] == 'NON_SYNONYMOUS':
-                            sections = line.split(',')
-                            nonsynonymous_SNPs += int(sections[1].strip())
-
-                        if line[:13] == 'STOP_GAINED ,':
-                            sections = line.split(',')
-                            snpEff['stops_gained'] = '{:,}'.format(int(sections[1].strip()))
-
-                        if line[:11] == 'STOP_LOST ,':
-                            sections = line.split(',')
-                            snpEff['stops_lost'] = '{:,}'.format(int(sections[1].strip()))
-
-
-            except:
-                self.LOG.error("Something went wrong with parsing the snpEff results")
-
-            if synonymous_SNPs > 0:
-                snpEff['synonymous_SNPs'] = '{:,}'.format(synonymous_SNPs)
-            if nonsynonymous_SNPs > 0:
-                snpEff['nonsynonymous_SNPs'] = '{:,}'.format(nonsynonymous_SNPs)
-
-            self.samples[sample_id]['snpeff'] = snpEff
+            sample['snpeff'] = snpEff
 
 
 
     def parse_picard_metrics(self):
         """ Parse the picard metrics file to get the duplication rates
         """
-        for sample_id in self.samples.iterkeys():
+        for sample_id, sample in self.samples.items():
 
             # Build the expected filenames
-            picard_metrics_fn = os.path.realpath(os.path.join(self.working_dir,
-                '05_processed_alignments', '{}.metrics'.format(sample_id)))
+            paths = self._sample_paths(sample_id)
             try:
-                with open(os.path.realpath(picard_metrics_fn), 'r') as fh:
-                    nextLine = False
-                    for line in fh:
-                        line = line.strip()
-                        if nextLine is True:
-                            parts = line.split("\t")
-                            percentDup = float(parts[7]) * 100
-                            self.samples[sample_id]['duplication_rate'] = '{:.2f}%'.format(percentDup)
-                            nextLine = False
-                        if line == 'LIBRARY	UNPAIRED_READS_EXAMINED	READ_PAIRS_EXAMINED	UNMAPPED_READS	UNPAIRED_READ_DUPLICATES	READ_PAIR_DUPLICATES	READ_PAIR_OPTICAL_DUPLICATES	PERCENT_DUPLICATION	ESTIMATED_LIBRARY_SIZE':
-                            nextLine = True
+                picard_metrics_buf, = self._batch_read_files([paths.picard_metrics])
+
+                # The metrics we want are on the line straight after the
+                # LIBRARY header, so jump to it and skip the histogram below
+                header_start = picard_metrics_buf.find(b'\nLIBRARY\t')
+                if header_start != -1:
+                    header_start += 1
+                    header_end = picard_metrics_buf.find(b'\n', header_start)
+                    if header_end != -1:
+                        data_end = picard_metrics_buf.find(b'\n', header_end + 1)
+                        if data_end == -1:
+                            data_end = len(picard_metrics_buf)
+                        header = picard_metrics_buf[header_start:header_end].rstrip(b'\r').split(b'\t')
+                        parts = picard_metrics_buf[header_end + 1:data_end].rstrip(b'\r').split(b'\t')
+                        percentDup = float(parts[header.index(b'PERCENT_DUPLICATION')]) * 100
+                        sample['duplication_rate'] = '{:.2f}%'.format(percentDup)
 
             except IOError:
                 self.LOG.warning("Warning: Could not find Picard metrics file for {}".format(sample_id))
-            except:
-                self.LOG.error("Something went wrong with parsing the picard metrics file")
+            except (OSError, ValueError, IndexError, KeyError):
+                self.LOG.error("Something went wrong with parsing the picard metrics file for sample {}".format(sample_id), exc_info=True)
 
 
 
     def make_plots(self):
-        """ Plot the visualizations for the IGN sample report
+        """ Plot the visualizations for the IGN sample report. Samples are
+        independent of each other so are plotted in parallel worker processes.
         """
-        for sample_id in self.samples.iterkeys():
-            # Create plots sample dict
-            self.plots[sample_id] = {}
-
-            # Create the plots subdirectory
-            plots_dir_rel = os.path.join('plots', sample_id)
-            plots_dir = os.path.realpath(os.path.join(self.report_dir, plots_dir_rel))
-            if not os.path.exists(plots_dir):
-                os.makedirs(plots_dir)
-
-            # Work out source directories
-            qualimap_raw_dir = os.path.realpath(os.path.join(self.working_dir, '06_final_alignment_qc',
-                '{}.clean.dedup.recal.qc'.format(sample_id), 'raw_data_qualimapReport'))
-            snpeff_data_dir = os.path.realpath(os.path.join(self.working_dir, '07_variant_calls'))
-
-            # Qualimap coverage plot
-            cov_fn = os.path.realpath(os.path.join(qualimap_raw_dir, 'coverage_histogram.txt'))
-            cov_output_rel = os.path.join(plots_dir_rel, '{}_coverage'.format(sample_id))
-            cov_output = os.path.join(plots_dir, '{}_coverage'.format(sample_id))
-            coverage_histogram.plot_coverage_histogram(cov_fn, cov_output)
-            self.plots[sample_id]['coverage_plot'] = cov_output_rel
-
-            # Qualimap genome fraction coverage plot
-            cov_frac_fn = os.path.realpath(os.path.join(qualimap_raw_dir, 'genome_fraction_coverage.txt'))
-            cov_frac_output_rel = os.path.join(plots_dir_rel, '{}_genome_fraction'.format(sample_id))
-            cov_frac_output = os.path.join(plots_dir, '{}_genome_fraction'.format(sample_id))
-            genome_fraction_coverage.plot_genome_fraction_coverage(cov_frac_fn, cov_frac_output)
-            self.plots[sample_id]['cov_frac_plot'] = cov_frac_output_rel
-
-            # Qualimap insert size plot
-            insert_size_fn = os.path.realpath(os.path.join(qualimap_raw_dir, 'insert_size_histogram.txt'))
-            insert_size_output_rel = os.path.join(plots_dir_rel, '{}_insert_size'.format(sample_id))
-            insert_size_output = os.path.join(plots_dir, '{}_insert_size'.format(sample_id))
-            insert_size.plot_insert_size_histogram(insert_size_fn, insert_size_output)
-            self.plots[sample_id]['insert_size_plot'] = insert_size_output_rel
-
-            # Qualimap GC distribution plot
-            gc_fn = os.path.realpath(os.path.join(qualimap_raw_dir, 'mapped_reads_gc-content_distribution.txt'))
-            gc_output_rel = os.path.join(plots_dir_rel, '{}_gc_distribution'.format(sample_id))
-            gc_output = os.path.join(plots_dir, '{}_gc_distribution'.format(sample_id))
-            gc_distribution.plot_genome_fraction_coverage(gc_fn, gc_output)
-            self.plots[sample_id]['gc_dist_plot'] = gc_output_rel
-
-            # snpEff plot
-            snpEFf_fn = os.path.realpath(os.path.join(snpeff_data_dir, '{}.clean.dedup.recal.bam.raw.annotated.vcf.snpEff.summary.csv'.format(sample_id)))
-            snpEFf_output_rel = os.path.join(plots_dir_rel, '{}_snpEff_effect'.format(sample_id))
-            snpEFf_output = os.path.join(plots_dir, '{}_snpEff_effect'.format(sample_id))
-            snpEff_plots.plot_snpEff(snpEFf_fn, snpEFf_output)
-            self.plots[sample_id]['snpEFf_plot'] = '{}_regions'.format(snpEFf_output_rel)
+        pool, plot_jobs = self._start_plots()
+        try:
+            self._collect_plots(plot_jobs)
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+
+    def _start_plots(self):
+        """ Start plotting every sample in a pool of worker processes and
+        return the pool and the pending jobs without waiting. Pass the jobs to
+        _collect_plots(), and terminate the pool if anything goes wrong first.
+        """
+        pool = multiprocessing.Pool(min(len(self.samples), multiprocessing.cpu_count()))
+        jobs = {}
+        try:
+            for sample_id in self.samples:
+                jobs[sample_id] = pool.apply_async(_render_sample_plots,
+                    (sample_id, self._sample_paths(sample_id), self.report_dir))
+        except BaseException:
+            pool.terminate()
+            raise
+        pool.close()
+        return pool, jobs
+
+
+    def _collect_plots(self, plot_jobs):
+        """ Wait for the plots started by _start_plots() and add their paths
+        to self.plots
+        """
+        for sample_id, job in plot_jobs.items():
+            self.plots[sample_id] = job.get(_PLOT_TIMEOUT)
 
 
 
+    def check_fields(self):
+        """ Check that the object has all required fields. Returns True / False.
+        """
+        if not self._check_global_fields():
+            return False
+        for sample_id in self.samples:
+            if not self._check_sample_fields(sample_id):
+                return False
+        return True
 
 
+    def _check_global_fields(self):
+        """ Check that the report and project have all required fields.
+        Returns True / False.
+        """
+        missing = _REQUIRED_REPORT_FIELDS.difference(self.info)
+        if missing:
+            self.LOG.error('Mandatory report fields missing: '+', '.join(sorted(missing)))
+            return False
+        missing = _REQUIRED_PROJECT_FIELDS.difference(self.project)
+        if missing:
+            self.LOG.error('Mandatory project fields missing: '+', '.join(sorted(missing)))
+            return False
+        return True
 
 
-    def check_fields(self):
-        """ Check that the object has all required fields. Returns True / False.
+    def _check_sample_fields(self, sample_id):
+        """ Check that a single sample has all required fields and plots.
+        Returns True / False.
         """
-        report_fields = []
-        project_fields = ['id', 'sequencing_centre', 'sequencing_platform', 'ref_genome']
-        sample_fields = ['total_reads',  'percent_aligned', 'aligned_reads', 'median_insert_size',
-            'automsomal_coverage', 'ref_above_30X', 'percent_gc']
-        plot_fields = ['coverage_plot', 'cov_frac_plot', 'insert_size_plot', 'gc_dist_plot', 'snpEFf_plot']
-
-        for f in report_fields:
-            if f not in self.info.keys():
-                self.LOG.error('Mandatory report field missing: '+f)
-                return False
-        for f in project_fields:
-            if f not in self.project.keys():
-                import json
-                print(json.dumps(self.project, indent=4))
-                self.LOG.error('Mandatory project field missing: '+f)
-                return False
-        for sample_id in self.samples.iterkeys():
-            for f in sample_fields:
-                if f not in self.samples[sample_id].keys():
-                    self.LOG.error('Mandatory sample field missing: '+f)
-                    return False
-            for f in plot_fields:
-                if f not in self.plots[sample_id].keys():
-                    self.LOG.error('Mandatory plot field missing: '+f)
-                    return False
+        missing = _REQUIRED_SAMPLE_FIELDS.difference(self.samples[sample_id])
+        if missing:
+            self.LOG.error('Mandatory sample fields missing: '+', '.join(sorted(missing)))
+            return False
+        missing = _REQUIRED_PLOT_FIELDS.difference(self.plots[sample_id])
+        if missing:
+            self.LOG.error('Mandatory plot fields missing: '+', '.join(sorted(missing)))
+            return False
         return True
 
 
 
     # Return the parsed markdown
+    # template is a compiled jinja2.Template, loaded once by the caller
+    # and rendered for every sample
     def parse_template(self, template):
 
         output_mds = {}
 
         self.LOG.info('Processing reports')
+
+        # Report and project fields are shared by every sample, so only check them once
+        if not self._check_global_fields():
+            self.LOG.error("Some mandatory report or project fields were missing - skipping all samples")
+            return output_mds
+
+        # Template fields that are the same for every sample
+        render_args = {'report': self.info, 'project': self.project}
+
         # Go through each sample making the report
-        for sample_id, sample in sorted(self.samples.iteritems()):
+        for sample_id, sample in sorted(self.samples.items()):
 
             # Make the file basename
             report_fn = sample_id + '_ign_sample_report'
             output_bn = os.path.realpath(os.path.join(self.working_dir, self.report_dir, report_fn))
 
             # check that we have everythin
-            if not self.check_fields():
+            if not self._check_sample_fields(sample_id):
                 self.LOG.error("Some mandatory fields were missing for sample {} - skipping".format(sample_id))
                 continue
 
             # Parse the template
             try:
-                md = template.render(report=self.info, project=self.project, sample=sample, plots=self.plots[sample_id])
+                md = template.render(sample=sample, plots=self.plots[sample_id], **render_args)
                 output_mds[output_bn] = md
             except:
                 self.LOG.error('Could not parse the ign_sample_report template for sample {} - skipping'.format(sample_id))
@@ -30,10 +30,10 @@ class Report(ign_sample_report.CommonReport):
             self.project['UPPMAXid'] = proj.get('uppnex_id')
 
             # Get sample fields from statusdb
-            for sid in self.samples.iterkeys():
+            for sid, sample in self.samples.items():
                 try:
-                    self.samples[sid]['user_sample_id'] = proj['samples'][sid]['customer_name']
-                    self.samples[sid]['barcode'] = proj['samples'][sid]['library_prep']['A']['reagent_label']
+                    sample['user_sample_id'] = proj['samples'][sid]['customer_name']
+                    sample['barcode'] = proj['samples'][sid]['library_prep']['A']['reagent_label']
                 except:
                     self.LOG.warn("Could not retrieve sample details from statusdb for {} {}. Skipping...".format(self.project['id'], sid))
 